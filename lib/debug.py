@@ -1,6 +1,5 @@
 import os
 import json
-import copy
 import re
 import time
 import cv2 as cv
@@ -40,17 +39,20 @@ class Debug:
 		Debug.base_img = img
 		Debug.img = np.copy(img)
 
+	# get_infos is a callable, so that a page's infos are only gathered when debugging;
+	# it builds fresh infos on each call (see Page.get_infos()), so they are stored without copying
 	@staticmethod
-	def add_step(name, infos):
+	def add_step(name, get_infos):
 		if not Debug.debug:
 			return
 
+		infos = get_infos()
 		elapsed = Debug.show_time(f"{name} ({len(infos['panels'])} panels)")
 
 		Debug.steps.append({
 			'name': name,
 			'elapsed_since_last_step': elapsed,
-			'infos': copy.deepcopy(infos),
+			'infos': infos,
 		})
 
 	@staticmethod
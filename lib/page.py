@@ -1,15 +1,20 @@
-import math
+import copy
+import heapq
 import os
 import json
 import sys
 import time
 import cv2 as cv
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.panel import Panel
 from lib.segment import Segment
 from lib.debug import Debug
 
+cv.setUseOptimized(True)
+cv.setNumThreads(cv.getNumberOfCPUs())
+
 
 class NotAnImageException(Exception):
 	pass
@@ -18,16 +23,18 @@ class NotAnImageException(Exception):
 class Page:
 
 	DEFAULT_MIN_PANEL_SIZE_RATIO = 1 / 10
+	MAX_PROCESSING_SIZE = 2000  # bigger images are downscaled to this size (in pixels) to detect panels
 
 	def get_infos(self):
 		actual_gutters = self.actual_gutters()
 
+		# debug steps keep these infos as they are (see Debug.add_step()): copy the page's mutable fields
 		return {
 			'filename': self.url if self.url else os.path.basename(self.filename),
-			'size': self.img_size,
+			'size': list(self.img_size),
 			'numbering': self.numbering,
 			'gutters': [actual_gutters['x'], actual_gutters['y']],
-			'license': self.license,
+			'license': copy.deepcopy(self.license),
 			'panels': list(map(lambda p: p.to_xywh(), self.panels)),
 			'processing_time': self.processing_time
 		}
@@ -63,6 +70,14 @@ class Page:
 		self.img_size = list(self.img.shape[:2])
 		self.img_size.reverse()  # get a [width,height] list
 
+		# Panels boundaries survive downscaling: giant scans are processed downscaled (img_size being the processing
+		# size meanwhile), and panels are scaled back to the original image size at the end
+		self.original_img_size = self.img_size
+		self.scale = 1
+		if max(self.img_size) > Page.MAX_PROCESSING_SIZE:
+			self.scale = Page.MAX_PROCESSING_SIZE / max(self.img_size)
+			self.img_size = [round(self.img_size[0] * self.scale), round(self.img_size[1] * self.scale)]
+
 		Debug.contour_size = 3
 
 		# get license for this file
@@ -75,21 +90,30 @@ class Page:
 					print(f"License file {filename+'.license'} is not a valid JSON file", file = sys.stderr)
 					sys.exit(1)
 
-		Debug.set_base_img(self.img)
+		if self.scale == 1:
+			Debug.set_base_img(self.img)
+		elif Debug.debug:
+			Debug.set_base_img(cv.resize(self.img, self.img_size, interpolation = cv.INTER_AREA))
 
-		Debug.add_step('Initial state', self.get_infos())
+		Debug.add_step('Initial state', self.get_infos)
 		Debug.add_image('Input image')
 
 		self.gray = cv.cvtColor(self.img, cv.COLOR_BGR2GRAY)
+		if self.scale != 1:
+			self.gray = cv.resize(self.gray, self.img_size, interpolation = cv.INTER_AREA)
 		Debug.add_image('Shades of gray', img = self.gray)
 		Debug.show_time("Shades of gray")
 
+		# With an OpenCL device, OpenCV's transparent API (UMat) runs the whole gradient stage and thresholding
+		# on the device, only the thresholded image is downloaded back (see get_contours)
+		gray = cv.UMat(self.gray) if cv.ocl.haveOpenCL() else self.gray
+
 		# https://docs.opencv.org/3.4/d2/d2c/tutorial_sobel_derivatives.html
 		ddepth = cv.CV_16S
-		grad_x = cv.Sobel(self.gray, ddepth, 1, 0, ksize = 3, scale = 1, delta = 0, borderType = cv.BORDER_DEFAULT)
+		grad_x = cv.Sobel(gray, ddepth, 1, 0, ksize = 3, scale = 1, delta = 0, borderType = cv.BORDER_DEFAULT)
 		# Gradient-Y
-		# grad_y = cv.Scharr(self.gray,ddepth,0,1)
-		grad_y = cv.Sobel(self.gray, ddepth, 0, 1, ksize = 3, scale = 1, delta = 0, borderType = cv.BORDER_DEFAULT)
+		# grad_y = cv.Scharr(gray,ddepth,0,1)
+		grad_y = cv.Sobel(gray, ddepth, 0, 1, ksize = 3, scale = 1, delta = 0, borderType = cv.BORDER_DEFAULT)
 
 		abs_grad_x = cv.convertScaleAbs(grad_x)
 		abs_grad_y = cv.convertScaleAbs(grad_y)
@@ -98,8 +122,18 @@ class Page:
 		Debug.add_image('Sobel filter applied', img = self.sobel)
 		Debug.show_time("Sobel filter")
 
-		self.get_contours()
-		self.get_segments()
+		if Debug.debug:
+			# debug images and timings are shared state, keep these steps sequential
+			self.get_contours()
+			self.get_segments()
+		else:
+			# both steps only read the gray and Sobel images, and OpenCV releases the GIL while working on them
+			with ThreadPoolExecutor(max_workers = 2) as executor:
+				contours = executor.submit(self.get_contours)
+				segments = executor.submit(self.get_segments)
+				contours.result()
+				segments.result()
+
 		self.get_initial_panels()
 		self.group_small_panels()
 		self.split_panels()
@@ -119,11 +153,16 @@ class Page:
 
 		self.fix_panels_numbering()
 
+		if self.scale != 1:
+			self.upscale_panels()
+
 		self.processing_time = int((time.time_ns() - t1) / 10**7) / 100
 
 	def get_contours(self):
 		# Black background: values above 100 will be black, the rest white
 		_, thresh = cv.threshold(self.sobel, 100, 255, cv.THRESH_BINARY)
+		if isinstance(thresh, cv.UMat):
+			thresh = thresh.get()
 		Debug.show_time("Image threshhold")
 
 		self.contours, _ = cv.findContours(thresh, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)[-2:]
@@ -141,23 +180,14 @@ class Page:
 
 		min_dist = min(self.img_size) * self.small_panel_ratio
 
-		while self.segments is None or len(self.segments) > 500:
-			self.segments = []
+		# [[x0, y0, x1, y1], ...] rounded line coordinates, and line lengths
+		lines = np.zeros((0, 4), dtype = np.int32)
+		if dlines is not None and dlines[0] is not None:
+			lines = np.rint(dlines[0].reshape(-1, 4)).astype(np.int32)
+		dists = np.sqrt((lines[:, 0] - lines[:, 2])**2 + (lines[:, 1] - lines[:, 3])**2)
 
-			if dlines is None or dlines[0] is None:
-				break
-
-			for dline in dlines[0]:
-				x0 = int(round(dline[0][0]))
-				y0 = int(round(dline[0][1]))
-				x1 = int(round(dline[0][2]))
-				y1 = int(round(dline[0][3]))
-
-				a = x0 - x1
-				b = y0 - y1
-				dist = math.sqrt(a**2 + b**2)
-				if dist >= min_dist:
-					self.segments.append(Segment([x0, y0], [x1, y1]))
+		while self.segments is None or len(self.segments) > 500:
+			self.segments = [Segment(line[:2], line[2:]) for line in lines[dists >= min_dist]]
 
 			min_dist *= 1.1
 
@@ -171,10 +201,11 @@ class Page:
 	def get_initial_panels(self):
 		self.panels = []
 		for contour in self.contours:
-			arclength = cv.arcLength(contour, True)
-			epsilon = 0.001 * arclength
-			approx = cv.approxPolyDP(contour, epsilon, True)
+			# approximated polygons fit in their contour's bounding rect: skip tiny contours before approximating them
+			if Panel(page = self, xywh = cv.boundingRect(contour)).is_very_small():
+				continue
 
+			approx = Page.approx_contour(contour)
 			panel = Panel(page = self, polygon = approx)
 			if panel.is_very_small():
 				continue
@@ -184,122 +215,188 @@ class Page:
 			self.panels.append(panel)
 
 		Debug.add_image('Initial contours')
-		Debug.add_step('Panels from initial contours', self.get_infos())
+		Debug.add_step('Panels from initial contours', self.get_infos)
+
+	@staticmethod
+	def approx_contour(contour):
+		arclength = cv.arcLength(contour, True)
+		epsilon = 0.001 * arclength
+		return cv.approxPolyDP(contour, epsilon, True)
 
 	# Group small panels that are close together, into bigger ones
 	def group_small_panels(self):
 		small_panels = list(filter(lambda p: p.is_small(), self.panels))
-		groups = {}
-		group_id = 0
-
-		for i, p1 in enumerate(small_panels):
-			for p2 in small_panels[i + 1:]:
-				if p1 == p2:
+		nb_small = len(small_panels)
+
+		bboxes = Panel.bboxes(small_panels)
+		widths = bboxes[:, 2] - bboxes[:, 0]
+		centers_x = bboxes[:, 0] + widths / 2
+
+		# Union-find, a group's root always being its first panel (keeps groups in panels order)
+		parent = list(range(nb_small))
+
+		def find(i):
+			while parent[i] != i:
+				parent[i] = parent[parent[i]]
+				i = parent[i]
+			return i
+
+		# Sweep panels by center x: only panels whose center is near enough on the x axis may be close
+		by_x = np.argsort(centers_x, kind = 'stable')
+		sorted_centers_x = centers_x[by_x]
+		max_width = widths.max(initial = 0)
+		for k, i in enumerate(by_x):
+			end = np.searchsorted(sorted_centers_x, centers_x[i] + (widths[i] + max_width) * 0.75, side = 'right')
+			candidates = by_x[k + 1:end]
+
+			for j in candidates[Panel.close_mask(bboxes[i], bboxes[candidates])]:
+				if small_panels[i] == small_panels[j]:
 					continue
 
-				if not p1.is_close(p2):
-					continue
+				root_i = find(i)
+				root_j = find(j)
+				if root_i != root_j:
+					parent[max(root_i, root_j)] = min(root_i, root_j)
+
+		roots = np.array([find(i) for i in range(nb_small)], dtype = np.int32)
+		by_root = np.argsort(roots, kind = 'stable')
+		sorted_roots = roots[by_root]
+		starts = np.flatnonzero(np.diff(sorted_roots, prepend = -1))
+		sizes = np.diff(np.append(starts, nb_small))
+
+		# Bounding boxes of all groups at once
+		group_x = np.minimum.reduceat(bboxes[by_root, 0], starts)
+		group_y = np.minimum.reduceat(bboxes[by_root, 1], starts)
+		group_r = np.maximum.reduceat(bboxes[by_root, 2], starts)
+		group_b = np.maximum.reduceat(bboxes[by_root, 3], starts)
+
+		nb_groups = 0
+		for g, start in enumerate(starts):
+			if sizes[g] < 2:
+				continue
 
-				if p1 not in groups and p2 not in groups:
-					group_id += 1
-					groups[p1] = group_id
-					groups[p2] = group_id
-				elif p1 in groups and p2 not in groups:
-					groups[p2] = groups[p1]
-				elif p2 in groups and p1 not in groups:
-					groups[p1] = groups[p2]
-				elif groups[p1] != groups[p2]:
-					# group group1 and group2 together
-					for p, id in groups.items():
-						if id == groups[p2]:
-							groups[p] = groups[p1]
-
-		grouped = {}
-		for k, v in groups.items():
-			grouped[v] = grouped.get(v, []) + [k]
-
-		for small_panels in grouped.values():
-			big_hull = cv.convexHull(np.concatenate(list(map(lambda p: p.polygon, small_panels))))
-			big_panel = Panel(page = self, polygon = big_hull, splittable = False)
+			nb_groups += 1
+			grouped = [small_panels[i] for i in by_root[start:start + sizes[g]]]
+			big_panel = Panel.from_xyrb(self, int(group_x[g]), int(group_y[g]), int(group_r[g]), int(group_b[g]))
+			big_panel.splittable = False
 
 			self.panels.append(big_panel)
-			for p in small_panels:
-				self.panels.remove(p)
+			self.remove_panels(grouped)
 
-			Debug.draw_contours(list(map(lambda p: p.polygon, small_panels)), Debug.colours['lightblue'])
-			Debug.draw_contours([big_panel.polygon], Debug.colours['red'])
+			Debug.draw_contours(list(map(lambda p: p.polygon, grouped)), Debug.colours['lightblue'])
+			Debug.draw_panels([big_panel], Debug.colours['red'])
 
-		if group_id > 0:
+		if nb_groups > 0:
 			Debug.add_image('Group small panels')
-		Debug.add_step('Group small panels', self.get_infos())
+		Debug.add_step('Group small panels', self.get_infos)
 
 	# See if panels can be cut into several (two non-consecutive points are close)
 	def split_panels(self):
-		did_split = True
-		while did_split:
-			did_split = False
-			for p in sorted(self.panels, key = lambda p: p.area(), reverse = True):
-				split = p.split()
-				if split is not None:
-					did_split = True
-					self.panels.remove(p)
-					self.panels += split.subpanels
-
-					Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
-					Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
-					break
+		# Biggest panels first: a max-heap on area, ties kept in panels order
+		# A panel that could not be split never will, so each panel is tried once
+		heap = [(-p.area(), i, p) for i, p in enumerate(self.panels)]
+		heapq.heapify(heap)
+		counter = len(heap)
+
+		while heap:
+			_, _, p = heapq.heappop(heap)
+			split = p.split()
+			if split is None:
+				continue
 
-			if did_split:
-				Debug.add_image(
-					'Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)'
-				)
+			self.remove_panels([p])
+			self.panels += split.subpanels
+			for subpanel in split.subpanels:
+				heapq.heappush(heap, (-subpanel.area(), counter, subpanel))
+				counter += 1
 
-		Debug.add_step(f"Panels from split contours ({len(self.segments)} segments)", self.get_infos())
+			Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
+			Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
+			Debug.add_image('Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)')
+
+		Debug.add_step(f"Panels from split contours ({len(self.segments)} segments)", self.get_infos)
+
+	# Remove given panels, by identity (Panel.__eq__ is a fuzzy comparison)
+	def remove_panels(self, panels):
+		ids = set(map(id, panels))
+		self.panels = [p for p in self.panels if id(p) not in ids]
 
 	def exclude_small_panels(self):
 		self.panels = list(filter(lambda p: not p.is_small(), self.panels))
 
-		Debug.add_step('Exclude small panels', self.get_infos())
+		Debug.add_step('Exclude small panels', self.get_infos)
 
 	# Splitting polygons may result in panels slightly overlapping, de-overlap them
 	def deoverlap_panels(self):
-		for p1 in self.panels:
-			for p2 in self.panels:
-				if p1 == p2:
-					continue
+		# De-overlapping only ever shrinks panels, so only panels overlapping from the start may need it
+		for i, j in Panel.overlap_pairs(Panel.bboxes(self.panels)):
+			p1 = self.panels[i]
+			p2 = self.panels[j]
+			if p1 == p2:
+				continue
 
-				opanel = p1.overlap_panel(p2)
-				if not opanel:
-					continue
+			opanel = p1.overlap_panel(p2)
+			if not opanel:
+				continue
 
-				if opanel.w() < opanel.h() and p1.r == opanel.r:
-					p1.r = opanel.x
-					p2.x = opanel.r
-					continue
+			if opanel.w() < opanel.h() and p1.r == opanel.r:
+				p1.r = opanel.x
+				p2.x = opanel.r
+				continue
 
-				if opanel.w() > opanel.h() and p1.b == opanel.b:
-					p1.b = opanel.y
-					p2.y = opanel.b
-					continue
+			if opanel.w() > opanel.h() and p1.b == opanel.b:
+				p1.b = opanel.y
+				p2.y = opanel.b
+				continue
 
-		Debug.add_step('Deoverlap panels', self.get_infos())
+		Debug.add_step('Deoverlap panels', self.get_infos)
 
 	# Merge panels that shouldn't have been split (speech bubble diving into a panel)
 	def merge_panels(self):
-		panels_to_remove = []
+		panels_to_remove = set()
+
+		bboxes = Panel.bboxes(self.panels)
+		areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+
 		for i, p1 in enumerate(self.panels):
-			for j, p2 in enumerate(self.panels[i + 1:]):
-				if p1.contains(p2):
-					panels_to_remove.append(p2)
-					p1 = p1.merge(p2)
-				elif p2.contains(p1):
-					panels_to_remove.append(p1)
-					p2 = p2.merge(p1)
+			j = i + 1
+			while j < len(self.panels):
+				# Panel.contains() between p1 and all panels after j, both ways
+				overlap_area = Panel.overlap_areas([p1.x, p1.y, p1.r, p1.b], bboxes[j:])
+				p1_contains = overlap_area * 2 > areas[j:]
+				p1_contained = overlap_area * 2 > p1.area()
+
+				for k in np.flatnonzero(p1_contains | p1_contained):
+					if p1_contains[k]:
+						panels_to_remove.add(j + k)
+						merged = p1.merge(self.panels[j + k])
+						if merged is not p1:
+							# p1 grew, check containment of the next panels again
+							p1 = merged
+							j += k + 1
+							break
+					else:
+						panels_to_remove.add(i)
+				else:
+					break
 
-		for p in set(panels_to_remove):
-			self.panels.remove(p)
+		# removed panels are tracked by position, a single rebuild avoids fuzzy Panel.__eq__ scans
+		self.panels = [p for i, p in enumerate(self.panels) if i not in panels_to_remove]
 
-		Debug.add_step('Merge panels', self.get_infos())
+		Debug.add_step('Merge panels', self.get_infos)
+
+	# Scale panels back from processing size to the original image size
+	def upscale_panels(self):
+		ratio_x = self.original_img_size[0] / self.img_size[0]
+		ratio_y = self.original_img_size[1] / self.img_size[1]
+
+		for p in self.panels:
+			p.x = round(p.x * ratio_x)
+			p.y = round(p.y * ratio_y)
+			p.r = min(round(p.r * ratio_x), self.original_img_size[0])
+			p.b = min(round(p.b * ratio_y), self.original_img_size[1])
+
+		self.img_size = self.original_img_size
 
 	# Find out actual gutters between panels
 	def actual_gutters(self, func = min):
@@ -327,6 +424,15 @@ class Page:
 	# Expand panels to their neighbour's edge, or page boundaries
 	def expand_panels(self):
 		gutters = self.actual_gutters()
+
+		# furthest known edges (frame around all panels), panels never get expanded beyond them
+		frame = {
+			'x': min([p.x for p in self.panels], default = 0),
+			'y': min([p.y for p in self.panels], default = 0),
+			'r': max([p.r for p in self.panels], default = 0),
+			'b': max([p.b for p in self.panels], default = 0),
+		}
+
 		for p in self.panels:
 			for d in ['x', 'y', 'r', 'b']:  # expand in all four directions
 				newcoord = -1
@@ -335,39 +441,62 @@ class Page:
 					# expand to that neighbour's edge (minus gutter)
 					newcoord = getattr(neighbour, {'x': 'r', 'r': 'x', 'y': 'b', 'b': 'y'}[d]) + gutters[d]
 				else:
-					# expand to the furthest known edge (frame around all panels)
-					min_panel = min(self.panels, key = lambda p: getattr(p, d)) if d in [
-						'x', 'y'
-					] else max(self.panels, key = lambda p: getattr(p, d))
-					newcoord = getattr(min_panel, d)
+					# expand to the furthest known edge
+					newcoord = frame[d]
 
 				if newcoord != -1:
 					if d in ['r', 'b'] and newcoord > getattr(p, d) or d in ['x', 'y'] and newcoord < getattr(p, d):
 						setattr(p, d, newcoord)
 
-		Debug.add_step('Expand panels', self.get_infos())
+		Debug.add_step('Expand panels', self.get_infos)
 
 	# Fix panels simple sorting (issue #12)
 	def fix_panels_numbering(self):
-		changes = 1
-		while changes:
-			changes = 0
-			for i, p in enumerate(self.panels):
-				neighbours_before = [p.find_top_panel()]
-				neighbours_before += p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels()
-
-				for neighbour in neighbours_before:
-					if neighbour is None:
-						continue
-					neighbour_pos = self.panels.index(neighbour)
-					if i < neighbour_pos:
-						changes += 1
-						self.panels.insert(neighbour_pos, self.panels.pop(i))
-						break
-				if changes > 0:
-					break  # start a new whole loop with reordered panels
+		# A panel's top neighbour, and left neighbours (right ones for rtl), should come before it.
+		# Panels are visited in topological order along these constraints (Kahn's algorithm), and given a sort key
+		# placing them right after the last panel they should follow (panels on the same row first, then the one
+		# below), or keeping their current place if it is later.
+		positions = {id(p): i for i, p in enumerate(self.panels)}
+		befores = []  # {position of a panel to come before: 0 if on the same row, 1 if above}
+		afters = [[] for p in self.panels]
+		for i, p in enumerate(self.panels):
+			before = {}
+			for n in p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels():
+				before[positions[id(n)]] = 0
+			top_panel = p.find_top_panel()
+			if top_panel is not None:
+				before.setdefault(positions[id(top_panel)], 1)
+			before.pop(i, None)
+
+			befores.append(before)
+			for j in before:
+				afters[j].append(i)
+
+		nb_before = list(map(len, befores))
+		ready = [i for i, nb in enumerate(nb_before) if nb == 0]
+		heapq.heapify(ready)
+		keys = [None] * len(self.panels)
+		nb_done = 0
+		while nb_done < len(self.panels):
+			if ready:
+				i = heapq.heappop(ready)
+			else:
+				# circular constraints, release the first remaining panel
+				i = keys.index(None)
+
+			if keys[i] is not None:
+				continue
+			keys[i] = max([(i, )] + [keys[j] + (below, i) for j, below in befores[i].items() if keys[j] is not None])
+			nb_done += 1
+
+			for j in afters[i]:
+				nb_before[j] -= 1
+				if nb_before[j] == 0:
+					heapq.heappush(ready, j)
+
+		self.panels = [self.panels[i] for i in sorted(range(len(self.panels)), key = lambda i: keys[i])]
 
-		Debug.add_step('Numbering fixed', self.get_infos())
+		Debug.add_step('Numbering fixed', self.get_infos)
 
 	# group big panels together
 	def group_big_panels(self):
@@ -393,12 +522,11 @@ class Page:
 						continue
 
 					self.panels.append(p3)
-					self.panels.remove(p1)
-					self.panels.remove(p2)
+					self.remove_panels([p1, p2])
 					grouped = True
 					break
 
 				if grouped:
 					break
 
-		Debug.add_step('Group big panels', self.get_infos())
+		Debug.add_step('Group big panels', self.get_infos)
@@ -49,7 +49,7 @@ class Panel:
 		# ht = height threshold
 
 	def to_xywh(self):
-		return [self.x, self.y, self.w(), self.h()]
+		return (self.x, self.y, self.w(), self.h())
 
 	def __eq__(self, other):
 		return all(
@@ -253,6 +253,55 @@ class Panel:
 			]
 		)
 
+	# Vectorized predicates, on NumPy arrays of panels bounding boxes: [[x, y, r, b], ...]
+
+	@staticmethod
+	def bboxes(panels):
+		return np.array([[p.x, p.y, p.r, p.b] for p in panels], dtype = np.int64).reshape(-1, 4)
+
+	# Same as is_close(), between bounding box xyrb and each of bboxes
+	@staticmethod
+	def close_mask(xyrb, bboxes):
+		w1 = xyrb[2] - xyrb[0]
+		h1 = xyrb[3] - xyrb[1]
+		w2 = bboxes[:, 2] - bboxes[:, 0]
+		h2 = bboxes[:, 3] - bboxes[:, 1]
+
+		c1x = xyrb[0] + w1 / 2
+		c1y = xyrb[1] + h1 / 2
+		c2x = bboxes[:, 0] + w2 / 2
+		c2y = bboxes[:, 1] + h2 / 2
+
+		return np.logical_and(
+			np.abs(c1x - c2x) <= (w1 + w2) * 0.75,
+			np.abs(c1y - c2y) <= (h1 + h2) * 0.75,
+		)
+
+	# Same as overlap_area(), between bounding box xyrb and each of bboxes
+	@staticmethod
+	def overlap_areas(xyrb, bboxes):
+		overlap_w = np.minimum(xyrb[2], bboxes[:, 2]) - np.maximum(xyrb[0], bboxes[:, 0])
+		overlap_h = np.minimum(xyrb[3], bboxes[:, 3]) - np.maximum(xyrb[1], bboxes[:, 1])
+		return np.maximum(overlap_w, 0) * np.maximum(overlap_h, 0)
+
+	# [[i, j], ...] pairs of distinct panels that overlap_panel() one another, in (i, j) order
+	@staticmethod
+	def overlap_pairs(bboxes):
+		# Sweep bounding boxes by left edge: only boxes starting before another's right edge may overlap it
+		by_x = np.argsort(bboxes[:, 0], kind = 'stable')
+		ends = np.searchsorted(bboxes[by_x, 0], bboxes[by_x, 2], side = 'right')
+
+		pairs = [np.zeros((0, 2), dtype = np.int64)]
+		for k, i in enumerate(by_x):
+			candidates = by_x[k + 1:ends[k]]
+			overlap = np.logical_and(bboxes[candidates, 1] <= bboxes[i, 3], bboxes[i, 1] <= bboxes[candidates, 3])
+			found = candidates[overlap]
+			pairs.append(np.stack([np.full(len(found), i), found], axis = 1))
+
+		pairs = np.concatenate(pairs)
+		pairs = np.concatenate([pairs, pairs[:, ::-1]])
+		return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
 	def bumps_into(self, other_panels):
 		for other in other_panels:
 			if other == self:
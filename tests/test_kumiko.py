@@ -3,7 +3,10 @@ import subprocess
 import json
 import re
 import os
+import cv2 as cv
 from tests.base import BaseTest
+from lib.page import Page
+from lib.panel import Panel
 
 
 class TestKumiko(BaseTest):
@@ -18,6 +21,12 @@ class TestKumiko(BaseTest):
 		[396, 696, 408, 468],
 	]
 
+	# A page whose panels are replaced by the given [x, y, width, height] boxes
+	def page_with_panels(self, panels, numbering = 'ltr'):
+		page = Page(self.simple_image, numbering = numbering)
+		page.panels = list(map(lambda p: Panel(page = page, xywh = p), panels))
+		return page
+
 	def test_simple_run(self):
 		res = subprocess.run(['./kumiko', '-i', self.simple_image], capture_output = True)
 		out = json.loads(res.stdout)
@@ -25,6 +34,64 @@ class TestKumiko(BaseTest):
 
 		self.assertPanelsEqual(panels, self.simple_image_panels)
 
+	def test_simple_run_without_panel_expansion(self):
+		res = subprocess.run(['./kumiko', '-i', self.simple_image, '--no-panel-expansion'], capture_output = True)
+		out = json.loads(res.stdout)
+		panels = out[0].get("panels", [])
+
+		self.assertPanelsEqual(panels, self.simple_image_panels)
+
+	def test_giant_image_run(self):
+		# images over Page.MAX_PROCESSING_SIZE are processed downscaled, panels are given in original image coordinates
+		img = cv.imread(self.simple_image)
+		giant_image = os.path.join(BaseTest.results_dir(), 'simple-x3.png')
+		cv.imwrite(giant_image, cv.resize(img, None, fx = 3, fy = 3))
+
+		res = subprocess.run(['./kumiko', '-i', giant_image], capture_output = True)
+		out = json.loads(res.stdout)
+
+		self.assertEqual(out[0].get("size"), [img.shape[1] * 3, img.shape[0] * 3])
+		self.assertPanelsEqual(out[0].get("panels", []), [[c * 3 for c in p] for p in self.simple_image_panels])
+
+	def test_group_small_panels_transitively(self):
+		# a chain of small panels, each one only close to its neighbours in the chain, in an order once split in two
+		chain = [[100 + 50 * i, 100, 50, 50] for i in range(5)]
+
+		page = self.page_with_panels([chain[i] for i in [0, 3, 1, 2, 4]])
+		page.group_small_panels()
+		self.assertPanelsEqual(list(map(lambda p: p.to_xywh(), page.panels)), [[100, 100, 250, 50]])
+
+	def test_merge_panels_keeps_container(self):
+		# the contained panel is fuzzy-equal to its container (Panel.__eq__), only the contained one must be removed
+		panels = [[100, 100, 400, 400], [110, 110, 380, 380], [600, 100, 200, 200]]
+
+		page = self.page_with_panels(panels)
+		page.merge_panels()
+		self.assertEqual(list(map(lambda p: list(p.to_xywh()), page.panels)), [panels[0], panels[2]])
+
+	def test_panels_numbering(self):
+		# a tall panel on the left of two stacked panels, above a full-width one
+		panels = [[50, 50, 300, 700], [400, 50, 400, 300], [400, 450, 400, 300], [50, 800, 750, 350]]
+
+		for order in [[0, 1, 2, 3], [1, 2, 0, 3], [3, 2, 1, 0], [2, 0, 3, 1]]:
+			page = self.page_with_panels([panels[i] for i in order])
+			page.fix_panels_numbering()
+			self.assertPanelsEqual(list(map(lambda p: p.to_xywh(), page.panels)), panels)
+
+		page = self.page_with_panels(panels, numbering = 'rtl')
+		page.fix_panels_numbering()
+		self.assertPanelsEqual(
+			list(map(lambda p: p.to_xywh(), page.panels)), [panels[1], panels[2], panels[0], panels[3]]
+		)
+
+	def test_panels_numbering_circular_constraints(self):
+		# each panel is to come after the previous one (left or top neighbour), and the first one after the last one
+		panels = [[700, 450, 50, 550], [750, 400, 50, 100], [650, 550, 250, 100], [650, 750, 50, 300]]
+
+		page = self.page_with_panels([panels[0], panels[3], panels[1], panels[2]])
+		page.fix_panels_numbering()
+		self.assertPanelsEqual(list(map(lambda p: p.to_xywh(), page.panels)), panels)
+
 	def test_panels_saving(self):
 		res = subprocess.run(
 			['./kumiko', '-i', self.simple_image, '--save-panels',